@@ -26,9 +26,14 @@
 #include <iostream>
 #include <vector>
 #include <map>
+#include <unordered_map>
+#include <numeric>
 #include <functional>
+#include <thread>
 #include <algorithm>
 #include <cmath>
+#include <limits>
+#include <stdexcept>
 #include <Eigen/Dense>
 
 
@@ -42,82 +47,360 @@
 // Class //
 //=======//
 
-struct SparseHist
+template<typename Scalar>
+struct BasicSparseHist
 {
 	// Some typedef {{{
 	typedef unsigned int size_type ;
 	typedef Eigen::VectorXi VectIndex ;
-	typedef Eigen::VectorXd VectValue ;
-	typedef Eigen::MatrixXd DataType ;
+	typedef Eigen::Matrix<Scalar,Eigen::Dynamic,1> VectValue ;
+	typedef Eigen::Matrix<Scalar,Eigen::Dynamic,Eigen::Dynamic> DataType ;
+	typedef Eigen::Matrix<Scalar,Eigen::Dynamic,Eigen::Dynamic,Eigen::RowMajor> RowDataType ;
+	typedef Eigen::Matrix<int,Eigen::Dynamic,Eigen::Dynamic,Eigen::RowMajor> IndexBlock ;
 	typedef std::function<bool(const VectIndex&,const VectIndex&)> OrderType ;
-	typedef std::map<VectIndex,int,OrderType> HashTable ;
+	
+	struct IndexHasher //{{{
+	{
+		std::size_t operator()( const VectIndex& index ) const
+		{
+			std::size_t h = static_cast<std::size_t>(index.size()) ;
+			for( int i = 0 ; i < index.size() ; ++i )
+			{
+				std::size_t k = static_cast<std::size_t>(static_cast<unsigned int>(index[i])) + 0x9e3779b97f4a7c15ULL ;
+				k = ( k ^ ( k >> 30 ) ) * 0xbf58476d1ce4e5b9ULL ;
+				k = ( k ^ ( k >> 27 ) ) * 0x94d049bb133111ebULL ;
+				h ^= ( k ^ ( k >> 31 ) ) + 0x9e3779b97f4a7c15ULL + ( h << 6 ) + ( h >> 2 ) ;
+			}
+			return h ;
+		}
+	} ;
+	//}}}
+	
+	typedef std::unordered_map<VectIndex,int,IndexHasher> HashTable ;
 	
 	//}}}
 	
 	// Constructor / Destructor {{{
 	
-	SparseHist( Eigen::Ref<const DataType> X , Eigen::Ref<const VectValue> bin_width ): //{{{
+	// X can be any Eigen matrix (column or row major, double or float):
+	// the samples are read in place, block by block, and never copied.
+	
+	template<class Derived>
+	BasicSparseHist( const Eigen::MatrixBase<Derived>& X , Eigen::Ref<const VectValue> bin_width , bool ordered = false , size_type n_threads = 1 ): //{{{
 		m_dim(bin_width.size()) ,
 		m_size(0) ,
+		m_ordered(ordered) ,
+		m_n_threads( std::max( n_threads , size_type(1) ) ) ,
+		m_n_samples(0) ,
+		m_dirty(false) ,
 		m_bin_width(bin_width) ,
-		m_bin_origin( Eigen::ArrayXd::Zero(m_dim) ) ,
+		m_bin_origin( VectValue::Zero(m_dim) ) ,
+		m_bin_edges() ,
 		m_alpha() ,
-		m_beta() ,
-		m_map( []( const VectIndex& x , const VectIndex& y ) { return std::lexicographical_compare( &x(0) , &x(0) + x.size() , &y(0) , &y(0).size() ) ; } ) ,
+		m_map() ,
+		m_keys() ,
+		m_counts() ,
 		m_c() ,
-		m_p()
+		m_p() ,
+		m_with_tree(false) ,
+		m_tree() ,
+		m_tree_dim()
 	{
 		initialize( X ) ;
 	}
 	//}}}
 	
-	SparseHist( Eigen::Ref<const DataType> X , Eigen::Ref<const VectValue> bin_width , Eigen::Ref<const VectValue> bin_origin )://{{{
+	template<class Derived>
+	BasicSparseHist( const Eigen::MatrixBase<Derived>& X , Eigen::Ref<const VectValue> bin_width , Eigen::Ref<const VectValue> bin_origin , bool ordered = false , size_type n_threads = 1 )://{{{
 		m_dim(bin_width.size()) ,
 		m_size(0) ,
+		m_ordered(ordered) ,
+		m_n_threads( std::max( n_threads , size_type(1) ) ) ,
+		m_n_samples(0) ,
+		m_dirty(false) ,
 		m_bin_width(bin_width) ,
 		m_bin_origin(bin_origin) ,
+		m_bin_edges() ,
 		m_alpha() ,
-		m_beta() ,
-		m_map( []( const VectIndex& x , const VectIndex& y ) { return std::lexicographical_compare( &x(0) , &x(0) + x.size() , &y(0) , &y(0).size() ) ; } ) ,
+		m_map() ,
+		m_keys() ,
+		m_counts() ,
 		m_c() ,
-		m_p()
+		m_p() ,
+		m_with_tree(false) ,
+		m_tree() ,
+		m_tree_dim()
 	{
 		initialize( X ) ;
 	}
 	//}}}
 	
-	void initialize( const DataType& X ) //{{{
+	template<class Derived>
+	BasicSparseHist( const Eigen::MatrixBase<Derived>& X , const std::vector<VectValue>& bin_edges , bool ordered = false , size_type n_threads = 1 )://{{{
+		m_dim(bin_edges.size()) ,
+		m_size(0) ,
+		m_ordered(ordered) ,
+		m_n_threads( std::max( n_threads , size_type(1) ) ) ,
+		m_n_samples(0) ,
+		m_dirty(false) ,
+		m_bin_width() ,
+		m_bin_origin() ,
+		m_bin_edges(bin_edges) ,
+		m_alpha() ,
+		m_map() ,
+		m_keys() ,
+		m_counts() ,
+		m_c() ,
+		m_p() ,
+		m_with_tree(false) ,
+		m_tree() ,
+		m_tree_dim()
+	{
+		// Non uniform bins: bin k of the dimension d is [edges[d][k],edges[d][k+1]).
+		// Outside of the edges, the grid is extended with bins of the width
+		// of the first (or last) bin. There is no single bin width, so
+		// bin_width and bin_origin are empty, bin_widths gives the width of
+		// each bin.
+		for( size_type d = 0 ; d < m_dim ; ++d )
+		{
+			const VectValue& e = m_bin_edges[d] ;
+			if( e.size() < 2 || !std::is_sorted( e.data() , e.data() + e.size() , std::less_equal<Scalar>() ) )
+				throw std::invalid_argument( "SparseHist: bin_edges must be strictly increasing, with at least two edges" ) ;
+		}
+		initialize( X ) ;
+	}
+	//}}}
+	
+	template<class Derived>
+	void initialize( const Eigen::MatrixBase<Derived>& X ) //{{{
 	{
 		// Linear mapping
-		m_alpha      = 1. / m_bin_width.array() ;
-		m_beta       = - m_bin_origin.array() * m_alpha.array() ;
+		m_alpha      = Scalar(1) / m_bin_width.array() ;
 		
-		// Bins estimation
-		for( int s = 0 ; s < X.rows() ; ++s )
+		add( X ) ;
+		finalize() ;
+	}
+	//}}}
+	
+	~BasicSparseHist()//{{{
+	{}
+	//}}}
+	
+	// }}}
+	
+	// Incremental construction {{{
+	
+	// A SparseHist built from an empty X (zero rows) can receive its data
+	// by blocks with add and merge (or lose it with remove), c and p are
+	// updated by finalize. Between a modification and finalize, argwhere
+	// and argnearest throw, since m_c and m_p do not match the bins.
+	// bin_keys / bin_counts are the integer state of the histogram,
+	// add_bins rebuilds it from them without the samples. They also throw
+	// before finalize, which drops the bins emptied by remove.
+	
+	template<class Derived>
+	void add( const Eigen::MatrixBase<Derived>& X ) //{{{
+	{
+		// Bins estimation, each new bin receives the next dense row
+		if( m_n_threads > 1 )
+		{
+			count_bins_parallel( X ) ;
+		}
+		else
+		{
+			for_each_bin( X , 0 , X.rows() , [this]( Eigen::Index , const VectIndex& key ) { insert_bin( key , 1 ) ; } ) ;
+		}
+		m_n_samples += X.rows() ;
+		m_dirty = true ;
+	}
+	//}}}
+	
+	void merge( const BasicSparseHist& other ) //{{{
+	{
+		if( !same_grid(other) )
+			throw std::invalid_argument( "SparseHist::merge: histograms must share bin_width and bin_origin (or bin_edges)" ) ;
+		for( std::size_t i = 0 ; i < other.m_keys.size() ; ++i )
+			insert_bin( other.m_keys[i] , other.m_counts[i] ) ;
+		m_n_samples += other.m_n_samples ;
+		m_dirty = true ;
+	}
+	//}}}
+	
+	template<class Derived>
+	void remove( const Eigen::MatrixBase<Derived>& X ) //{{{
+	{
+		// Inverse of add, used to slide a window over the data. Emptied
+		// bins are dropped by finalize. All rows are checked before any
+		// count is modified, so a failed remove leaves the histogram as is.
+		std::vector<int> rows( X.rows() ) ;
+		std::unordered_map<int,int> needed ;
+		for_each_bin( X , 0 , X.rows() , [&]( Eigen::Index s , const VectIndex& key ) {
+			typename HashTable::const_iterator it = m_map.find(key) ;
+			if( it == m_map.end() || ++needed[it->second] > m_counts[it->second] )
+				throw std::invalid_argument( "SparseHist::remove: row not counted in the histogram" ) ;
+			rows[s] = it->second ;
+		} ) ;
+		for( int row : rows )
+			m_counts[row]-- ;
+		m_n_samples -= X.rows() ;
+		m_dirty = true ;
+	}
+	//}}}
+	
+	void finalize() //{{{
+	{
+		// Drop the empty bins
+		if( std::find( m_counts.begin() , m_counts.end() , 0 ) != m_counts.end() )
 		{
-			m_map[bin_index(X.row(s))]++ ;
+			std::size_t n = 0 ;
+			for( std::size_t i = 0 ; i < m_keys.size() ; ++i )
+			{
+				if( m_counts[i] == 0 )
+				{
+					m_map.erase( m_keys[i] ) ;
+					continue ;
+				}
+				m_keys[n]   = m_keys[i] ;
+				m_counts[n] = m_counts[i] ;
+				m_map[m_keys[n]] = static_cast<int>(n) ;
+				++n ;
+			}
+			m_keys.resize(n) ;
+			m_counts.resize(n) ;
 		}
 		
+		// Rows follow the first occurrence of bins, or the lexicographic order
+		m_size = m_keys.size() ;
+		if( m_ordered )
+		{
+			std::vector<int> order( m_size ) ;
+			std::iota( order.begin() , order.end() , 0 ) ;
+			OrderType comp = lexicographic_order() ;
+			std::sort( order.begin() , order.end() , [this,&comp]( int i , int j ) { return comp( m_keys[i] , m_keys[j] ) ; } ) ;
+			std::vector<VectIndex> keys( m_size ) ;
+			std::vector<int> counts( m_size ) ;
+			for( size_type s = 0 ; s < m_size ; ++s )
+			{
+				keys[s]   = m_keys[order[s]] ;
+				counts[s] = m_counts[order[s]] ;
+				m_map[keys[s]] = static_cast<int>(s) ;
+			}
+			m_keys.swap(keys) ;
+			m_counts.swap(counts) ;
+		}
 		
 		// Final construction
-		m_size = m_map.size() ;
-		double dsize = static_cast<double>(X.rows()) ;
+		double dsize = static_cast<double>(m_n_samples) ;
 		m_p.resize( m_size ) ;
 		m_c.resize( m_size , m_dim ) ;
-		size_type s = 0 ;
-		for( auto& keyval : m_map )
+		for( size_type s = 0 ; s < m_size ; ++s )
 		{
-			m_p[s] = keyval.second / dsize ;
-			m_c.row(s++) = bin_center(keyval.first) ;
+			m_p[s] = static_cast<Scalar>( m_counts[s] / dsize ) ;
+			m_c.row(s) = bin_center(m_keys[s]) ;
 		}
+		
+		// The k-d tree of argnearest follows the new centers
+		if( m_with_tree )
+			build_tree() ;
+		m_dirty = false ;
 	}
 	//}}}
 	
-	~SparseHist()//{{{
-	{}
+	void add_bins( Eigen::Ref<const IndexBlock> keys , Eigen::Ref<const VectIndex> counts ) //{{{
+	{
+		// Restore bins saved with bin_keys / bin_counts, without the samples
+		if( keys.cols() != static_cast<Eigen::Index>(m_dim) || keys.rows() != counts.size() )
+			throw std::invalid_argument( "SparseHist::add_bins: keys must be of shape (counts.size(),dim)" ) ;
+		if( counts.size() > 0 && counts.minCoeff() <= 0 )
+			throw std::invalid_argument( "SparseHist::add_bins: counts must be positive" ) ;
+		for( Eigen::Index s = 0 ; s < keys.rows() ; ++s )
+		{
+			insert_bin( keys.row(s).transpose() , counts[s] ) ;
+			m_n_samples += counts[s] ;
+		}
+		m_dirty = true ;
+	}
 	//}}}
 	
-	// }}}
+	IndexBlock bin_keys() const //{{{
+	{
+		if( m_dirty )
+			throw std::logic_error( "SparseHist::bin_keys: finalize must be called after add, merge, remove or add_bins" ) ;
+		IndexBlock keys( m_keys.size() , m_dim ) ;
+		for( std::size_t s = 0 ; s < m_keys.size() ; ++s )
+			keys.row(s) = m_keys[s].transpose() ;
+		return keys ;
+	}
+	//}}}
+	
+	VectIndex bin_counts() const //{{{
+	{
+		if( m_dirty )
+			throw std::logic_error( "SparseHist::bin_counts: finalize must be called after add, merge, remove or add_bins" ) ;
+		return Eigen::Map<const VectIndex>( m_counts.data() , m_counts.size() ) ;
+	}
+	//}}}
+	
+	void insert_bin( const VectIndex& key , int count ) //{{{
+	{
+		auto res = m_map.emplace( key , static_cast<int>(m_keys.size()) ) ;
+		if( res.second )
+		{
+			m_keys.push_back( key ) ;
+			m_counts.push_back(0) ;
+		}
+		m_counts[res.first->second] += count ;
+	}
+	//}}}
+	
+	template<class Derived>
+	void count_bins_parallel( const Eigen::MatrixBase<Derived>& X ) //{{{
+	{
+		// Each thread groups a contiguous block of rows in its own table
+		size_type n_threads = std::min( m_n_threads , static_cast<size_type>(std::max( X.rows() , Eigen::Index(1) )) ) ;
+		std::vector<HashTable> lmap( n_threads ) ;
+		std::vector<std::vector<VectIndex>> lkeys( n_threads ) ;
+		std::vector<std::vector<int>> lcounts( n_threads ) ;
+		
+		auto worker = [&]( size_type t ) {
+			const Eigen::Index begin = X.rows() * t / n_threads ;
+			const Eigen::Index end   = X.rows() * (t+1) / n_threads ;
+			for_each_bin( X , begin , end , [&]( Eigen::Index , const VectIndex& key ) {
+				auto it = lmap[t].find(key) ;
+				if( it == lmap[t].end() )
+				{
+					it = lmap[t].emplace( key , static_cast<int>(lkeys[t].size()) ).first ;
+					lkeys[t].push_back(key) ;
+					lcounts[t].push_back(0) ;
+				}
+				lcounts[t][it->second]++ ;
+			} ) ;
+		} ;
+		
+		std::vector<std::thread> threads ;
+		for( size_type t = 1 ; t < n_threads ; ++t )
+			threads.emplace_back( worker , t ) ;
+		worker(0) ;
+		for( auto& th : threads )
+			th.join() ;
+		
+		// Reduction in the order of the blocks, so the first occurrence order is kept
+		for( size_type t = 0 ; t < n_threads ; ++t )
+		{
+			lmap[t].clear() ;
+			for( std::size_t i = 0 ; i < lkeys[t].size() ; ++i )
+				insert_bin( lkeys[t][i] , lcounts[t][i] ) ;
+		}
+	}
+	//}}}
+	
+	//}}}
+	
+	static OrderType lexicographic_order() //{{{
+	{
+		return []( const VectIndex& x , const VectIndex& y ) { return std::lexicographical_compare( x.data() , x.data() + x.size() , y.data() , y.data() + y.size() ) ; } ;
+	}
+	//}}}
 	
 	std::string repr()//{{{
 	{
@@ -132,49 +415,396 @@ struct SparseHist
 	
 	// Methods {{{
 	
-	VectIndex bin_index( const VectValue& x )
+	template<class Derived>
+	VectIndex bin_index( const Eigen::MatrixBase<Derived>& x ) const
+	{
+		RowDataType row(1,m_dim) ;
+		for( size_type d = 0 ; d < m_dim ; ++d )
+			row(0,d) = static_cast<Scalar>(x(d)) ;
+		IndexBlock index ;
+		bin_index_block( row , index ) ;
+		return index.row(0).transpose() ;
+	}
+	
+	template<class Derived,class Function>
+	void for_each_bin( const Eigen::MatrixBase<Derived>& X , Eigen::Index begin , Eigen::Index end , Function f ) const
+	{
+		// Call f(s,key) with the bin key of each row s in [begin,end) of X,
+		// the keys being computed by blocks with bin_index_block.
+		const Eigen::Index bsize = 4096 ;
+		IndexBlock index ;
+		VectIndex key(m_dim) ;
+		for( Eigen::Index b = begin ; b < end ; b += bsize )
+		{
+			Eigen::Index nrow = std::min( bsize , end - b ) ;
+			bin_index_block( X.middleRows(b,nrow) , index ) ;
+			for( Eigen::Index s = 0 ; s < nrow ; ++s )
+			{
+				key = index.row(s).transpose() ;
+				f( b + s , key ) ;
+			}
+		}
+	}
+	
+	template<class Derived>
+	void bin_index_block( const Eigen::MatrixBase<Derived>& X , IndexBlock& index ) const
+	{
+		// Bin indexes of all rows of X, one dimension at a time. This is the
+		// only routine computing bins, so every path (threads, argwhere,
+		// remove) gives the same bin to a value lying on an edge. It is
+		// written (x - origin) * alpha, which cannot be contracted into an
+		// fma, so packet and scalar code round identically.
+		if( m_bin_edges.empty() )
+		{
+			index = ( ( X.template cast<Scalar>().rowwise() - m_bin_origin.transpose() ).array().rowwise() * m_alpha.transpose().array() ).floor().template cast<int>() ;
+			return ;
+		}
+		index.resize( X.rows() , m_dim ) ;
+		for( size_type d = 0 ; d < m_dim ; ++d )
+		{
+			const VectValue& e = m_bin_edges[d] ;
+			for( Eigen::Index s = 0 ; s < X.rows() ; ++s )
+				index(s,d) = edge_index( e , static_cast<Scalar>(X(s,d)) ) ;
+		}
+	}
+	
+	static int edge_index( const VectValue& e , Scalar x )
 	{
-		VectIndex index = ( m_alpha.array() * x.array() + m_beta.array() ).floor().cast<int>() ;
-		return index ;
+		const int n_bins = static_cast<int>(e.size()) - 1 ;
+		if( x < e[0] )
+			return static_cast<int>(std::floor( ( x - e[0] ) / ( e[1] - e[0] ) )) ;
+		if( x >= e[n_bins] )
+			return n_bins + static_cast<int>(std::floor( ( x - e[n_bins] ) / ( e[n_bins] - e[n_bins-1] ) )) ;
+		return static_cast<int>( std::upper_bound( e.data() , e.data() + e.size() , x ) - e.data() ) - 1 ;
 	}
 	
-	VectValue bin_center( const VectIndex& index )
+	VectValue bin_center( const VectIndex& index ) const
 	{
 		VectValue x(m_dim) ;
 		for( size_type s = 0 ; s < m_dim ; ++s )
 		{
-			x[s] = m_bin_origin[s] + m_bin_width[s] * static_cast<double>(index[s]) + m_bin_width[s] / 2. ;
+			if( m_bin_edges.empty() )
+			{
+				x[s] = m_bin_origin[s] + m_bin_width[s] * static_cast<Scalar>(index[s]) + m_bin_width[s] / Scalar(2) ;
+				continue ;
+			}
+			const VectValue& e = m_bin_edges[s] ;
+			const int n_bins = static_cast<int>(e.size()) - 1 ;
+			if( index[s] < 0 )
+				x[s] = e[0] + ( e[1] - e[0] ) * ( static_cast<Scalar>(index[s]) + Scalar(0.5) ) ;
+			else if( index[s] >= n_bins )
+				x[s] = e[n_bins] + ( e[n_bins] - e[n_bins-1] ) * ( static_cast<Scalar>(index[s] - n_bins) + Scalar(0.5) ) ;
+			else
+				x[s] = ( e[index[s]] + e[index[s]+1] ) / Scalar(2) ;
 		}
 		return x ;
 	}
 	
-	VectIndex argwhere( Eigen::Ref<const DataType> X )
+	VectValue bin_width_of( const VectIndex& index ) const
 	{
-		VectIndex index ;
-		VectIndex lIndex(Eigen::VectorXi::Zero(X.rows())) ;
-		typename HashTable::iterator it ;
-		for( int s = 0 ; s < X.rows() ; ++s )
+		if( m_bin_edges.empty() )
+			return m_bin_width ;
+		VectValue w(m_dim) ;
+		for( size_type s = 0 ; s < m_dim ; ++s )
 		{
-			index = bin_index(X.row(s)) ;
-			it = m_map.find( index ) ;
-			lIndex[s] = static_cast<int>( ( it == m_map.end() ) ? -1 : std::distance( m_map.begin() , it ) ) ;
+			const VectValue& e = m_bin_edges[s] ;
+			const int n_bins = static_cast<int>(e.size()) - 1 ;
+			const int k = std::min( std::max( index[s] , 0 ) , n_bins - 1 ) ;
+			w[s] = e[k+1] - e[k] ;
 		}
+		return w ;
+	}
+	
+	DataType bin_widths() const
+	{
+		// Width of each bin (rows of m_c) along each dimension
+		DataType w( m_size , m_dim ) ;
+		for( size_type s = 0 ; s < m_size ; ++s )
+			w.row(s) = bin_width_of(m_keys[s]).transpose() ;
+		return w ;
+	}
+	
+	bool same_grid( const BasicSparseHist& other ) const
+	{
+		if( other.m_dim != m_dim || other.m_bin_edges.size() != m_bin_edges.size() || other.m_bin_width.size() != m_bin_width.size() )
+			return false ;
+		if( other.m_bin_width != m_bin_width || other.m_bin_origin != m_bin_origin )
+			return false ;
+		for( std::size_t d = 0 ; d < m_bin_edges.size() ; ++d )
+		{
+			if( other.m_bin_edges[d].size() != m_bin_edges[d].size() || other.m_bin_edges[d] != m_bin_edges[d] )
+				return false ;
+		}
+		return true ;
+	}
+	
+	// argwhere / argnearest are not overloaded, so &SparseHist::argwhere
+	// stays a valid function pointer for the bindings. The _into variants
+	// write in a caller provided array, the _rowmajor variants read C
+	// ordered arrays in place.
+	
+	VectIndex argwhere( Eigen::Ref<const DataType> X ) const
+	{
+		VectIndex lIndex(Eigen::VectorXi::Zero(X.rows())) ;
+		argwhere_impl( X , lIndex ) ;
+		return lIndex ;
+	}
+	
+	void argwhere_into( Eigen::Ref<const DataType> X , Eigen::Ref<VectIndex> lIndex ) const
+	{
+		argwhere_impl( X , lIndex ) ;
+	}
+	
+	VectIndex argwhere_rowmajor( Eigen::Ref<const RowDataType> X ) const
+	{
+		VectIndex lIndex(Eigen::VectorXi::Zero(X.rows())) ;
+		argwhere_impl( X , lIndex ) ;
+		return lIndex ;
+	}
+	
+	void argwhere_rowmajor_into( Eigen::Ref<const RowDataType> X , Eigen::Ref<VectIndex> lIndex ) const
+	{
+		argwhere_impl( X , lIndex ) ;
+	}
+	
+	template<class Derived>
+	void argwhere_impl( const Eigen::MatrixBase<Derived>& X , Eigen::Ref<VectIndex> lIndex ) const
+	{
+		if( m_dirty )
+			throw std::logic_error( "SparseHist::argwhere: finalize must be called after add, merge, remove or add_bins" ) ;
+		if( lIndex.size() != X.rows() )
+			throw std::invalid_argument( "SparseHist::argwhere: index must have X.rows() elements" ) ;
+		for_each_bin( X , 0 , X.rows() , [&]( Eigen::Index s , const VectIndex& key ) {
+			typename HashTable::const_iterator it = m_map.find(key) ;
+			lIndex[s] = ( it == m_map.end() ) ? -1 : it->second ;
+		} ) ;
+	}
+	
+	const DataType& c() const
+	{
+		return m_c ;
+	}
+	
+	const VectValue& p() const
+	{
+		return m_p ;
+	}
+	
+	VectIndex argnearest( Eigen::Ref<const DataType> X ) const //{{{
+	{
+		VectIndex lIndex(Eigen::VectorXi::Zero(X.rows())) ;
+		argnearest_impl( X , lIndex ) ;
+		return lIndex ;
+	}
+	//}}}
+	
+	void argnearest_into( Eigen::Ref<const DataType> X , Eigen::Ref<VectIndex> lIndex ) const //{{{
+	{
+		argnearest_impl( X , lIndex ) ;
+	}
+	//}}}
+	
+	VectIndex argnearest_rowmajor( Eigen::Ref<const RowDataType> X ) const //{{{
+	{
+		VectIndex lIndex(Eigen::VectorXi::Zero(X.rows())) ;
+		argnearest_impl( X , lIndex ) ;
 		return lIndex ;
 	}
 	//}}}
 	
+	void argnearest_rowmajor_into( Eigen::Ref<const RowDataType> X , Eigen::Ref<VectIndex> lIndex ) const //{{{
+	{
+		argnearest_impl( X , lIndex ) ;
+	}
+	//}}}
+	
+	template<class Derived>
+	void argnearest_impl( const Eigen::MatrixBase<Derived>& X , Eigen::Ref<VectIndex> lIndex ) const //{{{
+	{
+		// As argwhere, but rows outside of the occupied bins are given the
+		// bin with the nearest center (euclidean distance), found in a k-d tree.
+		if( lIndex.size() != X.rows() )
+			throw std::invalid_argument( "SparseHist::argnearest: index must have X.rows() elements" ) ;
+		if( m_dirty )
+			throw std::logic_error( "SparseHist::argnearest: finalize must be called after add, merge, remove or add_bins" ) ;
+		if( !m_with_tree )
+			throw std::logic_error( "SparseHist::argnearest: build_tree must be called first" ) ;
+		if( m_size == 0 )
+		{
+			lIndex.setConstant(-1) ;
+			return ;
+		}
+		
+		const Eigen::Index n_rows = X.rows() ;
+		size_type n_threads = std::min( m_n_threads , static_cast<size_type>(std::max( n_rows , Eigen::Index(1) )) ) ;
+		auto worker = [&]( size_type t ) {
+			const Eigen::Index begin = n_rows * t / n_threads ;
+			const Eigen::Index end   = n_rows * (t+1) / n_threads ;
+			VectValue x(m_dim) ;
+			for_each_bin( X , begin , end , [&]( Eigen::Index s , const VectIndex& key ) {
+				typename HashTable::const_iterator it = m_map.find(key) ;
+				if( it != m_map.end() )
+				{
+					lIndex[s] = it->second ;
+					return ;
+				}
+				x = X.row(s).transpose().template cast<Scalar>() ;
+				int best = -1 ;
+				Scalar best_dist = std::numeric_limits<Scalar>::infinity() ;
+				nearest( x , 0 , m_size , best , best_dist ) ;
+				lIndex[s] = best ;
+			} ) ;
+		} ;
+		
+		std::vector<std::thread> threads ;
+		for( size_type t = 1 ; t < n_threads ; ++t )
+			threads.emplace_back( worker , t ) ;
+		worker(0) ;
+		for( auto& th : threads )
+			th.join() ;
+	}
+	//}}}
+	
+	void build_tree() //{{{
+	{
+		// k-d tree on the rows of m_c, stored in place in m_tree: the node of
+		// the range [lo,hi) is m_tree[(lo+hi)/2], split along m_tree_dim[(lo+hi)/2].
+		// Once built, it is rebuilt by each finalize, so argnearest never
+		// modifies the histogram and can be called from several threads.
+		m_with_tree = true ;
+		m_tree.resize( m_size ) ;
+		std::iota( m_tree.begin() , m_tree.end() , 0 ) ;
+		m_tree_dim.assign( m_size , 0 ) ;
+		build_tree( 0 , m_size ) ;
+	}
+	//}}}
+	
+	void build_tree( size_type lo , size_type hi ) //{{{
+	{
+		if( hi - lo <= s_leaf_size )
+			return ;
+		
+		// Split along the dimension of largest spread
+		int dim = 0 ;
+		Scalar spread = -1 ;
+		for( size_type d = 0 ; d < m_dim ; ++d )
+		{
+			Scalar vmin = m_c(m_tree[lo],d) , vmax = vmin ;
+			for( size_type i = lo + 1 ; i < hi ; ++i )
+			{
+				vmin = std::min( vmin , m_c(m_tree[i],d) ) ;
+				vmax = std::max( vmax , m_c(m_tree[i],d) ) ;
+			}
+			if( vmax - vmin > spread )
+			{
+				spread = vmax - vmin ;
+				dim = static_cast<int>(d) ;
+			}
+		}
+		
+		size_type mid = ( lo + hi ) / 2 ;
+		std::nth_element( m_tree.begin() + lo , m_tree.begin() + mid , m_tree.begin() + hi , [this,dim]( int i , int j ) { return m_c(i,dim) < m_c(j,dim) ; } ) ;
+		m_tree_dim[mid] = dim ;
+		build_tree( lo , mid ) ;
+		build_tree( mid + 1 , hi ) ;
+	}
+	//}}}
+	
+	void nearest( const VectValue& x , size_type lo , size_type hi , int& best , Scalar& best_dist ) const //{{{
+	{
+		if( hi - lo <= s_leaf_size )
+		{
+			for( size_type i = lo ; i < hi ; ++i )
+				update_nearest( x , m_tree[i] , best , best_dist ) ;
+			return ;
+		}
+		
+		size_type mid = ( lo + hi ) / 2 ;
+		update_nearest( x , m_tree[mid] , best , best_dist ) ;
+		Scalar diff = x[m_tree_dim[mid]] - m_c(m_tree[mid],m_tree_dim[mid]) ;
+		if( diff < 0 )
+		{
+			nearest( x , lo , mid , best , best_dist ) ;
+			if( diff * diff < best_dist )
+				nearest( x , mid + 1 , hi , best , best_dist ) ;
+		}
+		else
+		{
+			nearest( x , mid + 1 , hi , best , best_dist ) ;
+			if( diff * diff < best_dist )
+				nearest( x , lo , mid , best , best_dist ) ;
+		}
+	}
+	//}}}
+	
+	void update_nearest( const VectValue& x , int i , int& best , Scalar& best_dist ) const //{{{
+	{
+		Scalar dist = ( m_c.row(i).transpose() - x ).squaredNorm() ;
+		if( dist < best_dist )
+		{
+			best_dist = dist ;
+			best = i ;
+		}
+	}
+	//}}}
+	
+	BasicSparseHist coarsen( size_type factor ) const //{{{
+	{
+		// Histogram on a grid 'factor' times coarser, with the same origin.
+		// The coarse bin of the rows of m_c is given by coarse.argwhere(m_c).
+		if( !m_bin_edges.empty() )
+			throw std::invalid_argument( "SparseHist::coarsen: not available with bin_edges" ) ;
+		if( factor < 1 || factor > static_cast<size_type>(std::numeric_limits<int>::max()) )
+			throw std::invalid_argument( "SparseHist::coarsen: factor must be between 1 and INT_MAX" ) ;
+		VectValue bin_width = m_bin_width * static_cast<Scalar>(factor) ;
+		BasicSparseHist coarse( DataType(0,m_dim) , bin_width , m_bin_origin , m_ordered , m_n_threads ) ;
+		const int f = static_cast<int>(factor) ;
+		VectIndex key(m_dim) ;
+		for( std::size_t i = 0 ; i < m_keys.size() ; ++i )
+		{
+			for( size_type d = 0 ; d < m_dim ; ++d )
+			{
+				// Floor division, written to not overflow for large f
+				key[d] = m_keys[i][d] / f ;
+				if( m_keys[i][d] % f < 0 )
+					--key[d] ;
+			}
+			coarse.insert_bin( key , m_counts[i] ) ;
+		}
+		coarse.m_n_samples = m_n_samples ;
+		coarse.finalize() ;
+		return coarse ;
+	}
+	//}}}
+	//}}}
+	
 	// Arguments {{{
 	size_type	m_dim ;
 	size_type	m_size ;
+	bool		m_ordered ;
+	size_type	m_n_threads ;
+	std::size_t	m_n_samples ;
+	bool		m_dirty ;
 	VectValue	m_bin_width ;
 	VectValue	m_bin_origin ;
+	std::vector<VectValue> m_bin_edges ;
 	VectValue	m_alpha ;
-	VectValue	m_beta ;
 	HashTable	m_map ;
+	std::vector<VectIndex> m_keys ;
+	std::vector<int> m_counts ;
 	DataType	m_c ;
 	VectValue	m_p ;
+	bool		m_with_tree ;
+	std::vector<int> m_tree ;
+	std::vector<int> m_tree_dim ;
+	static const size_type s_leaf_size = 8 ;
 	//}}}
 };
 
+// SparseHist works in double precision, SparseHistF in single precision
+// (bin widths, centers and probabilities), for float32 data.
+typedef BasicSparseHist<double> SparseHist ;
+typedef BasicSparseHist<float>  SparseHistF ;
+
 
 #endif
@@ -0,0 +1,386 @@
+// Copyright(c) 2021 Yoann Robin
+//
+// This file is part of SBCK.
+//
+// SBCK is free software: you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation, either version 3 of the License, or
+// (at your option) any later version.
+//
+// SBCK is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with SBCK.  If not, see <https://www.gnu.org/licenses/>.
+
+// Build and run from the root of the repository:
+// g++ -std=c++11 -O2 -pthread -I/usr/include/eigen3 -Icpp tests/test_SparseHist.cpp -o test_SparseHist && ./test_SparseHist
+
+//-----------//
+// Libraries //
+//-----------//
+
+#include <iostream>
+#include <string>
+#include <vector>
+#include <map>
+#include <thread>
+#include <cstdlib>
+#include <cmath>
+#include <limits>
+#include <Eigen/Dense>
+
+#include "SparseHist.hpp"
+
+
+//===========//
+// Functions //
+//===========//
+
+static int n_failures = 0 ;
+
+void check( bool cond , const std::string& name )//{{{
+{
+	if( !cond )
+	{
+		std::cout << "FAILED: " << name << std::endl ;
+		n_failures++ ;
+	}
+}
+//}}}
+
+bool same_hist( const SparseHist& a , const SparseHist& b )//{{{
+{
+	return a.m_size == b.m_size && a.m_c.rows() == b.m_c.rows() && a.m_c == b.m_c && a.m_p == b.m_p ;
+}
+//}}}
+
+Eigen::VectorXi brute_nearest( const SparseHist& h , const Eigen::MatrixXd& X )//{{{
+{
+	Eigen::VectorXi index(X.rows()) ;
+	for( int s = 0 ; s < X.rows() ; ++s )
+	{
+		Eigen::Index i ;
+		( h.m_c.rowwise() - X.row(s) ).rowwise().squaredNorm().minCoeff(&i) ;
+		index[s] = static_cast<int>(i) ;
+	}
+	return index ;
+}
+//}}}
+
+
+void test_argwhere()//{{{
+{
+	Eigen::MatrixXd X = Eigen::MatrixXd::Random(20000,3) ;
+	Eigen::VectorXd bw(3) ; bw << 0.05 , 0.1 , 0.07 ;
+	SparseHist h( X , bw ) ;
+	SparseHist ho( X , bw , true ) ;
+
+	// Reference: lexicographic std::map of the bins
+	std::map<std::vector<int>,int> ref ;
+	for( int s = 0 ; s < X.rows() ; ++s )
+	{
+		Eigen::VectorXi k = h.bin_index(X.row(s)) ;
+		ref[std::vector<int>( k.data() , k.data() + k.size() )]++ ;
+	}
+	check( ho.m_size == ref.size() && h.m_size == ref.size() , "argwhere: number of bins" ) ;
+	int s = 0 ;
+	bool ok = true ;
+	for( auto& kv : ref )
+	{
+		Eigen::VectorXi k = Eigen::Map<const Eigen::VectorXi>( kv.first.data() , 3 ) ;
+		ok = ok && ho.m_c.row(s) == ho.bin_center(k).transpose() && ho.m_p[s] == kv.second / 20000. ;
+		++s ;
+	}
+	check( ok , "argwhere: ordered layout equals the lexicographic map" ) ;
+
+	// Every row is found in the bin containing it, in both layouts
+	Eigen::VectorXi ih = h.argwhere(X) , iho = ho.argwhere(X) ;
+	ok = true ;
+	for( int r = 0 ; r < X.rows() ; ++r )
+		ok = ok && ih[r] >= 0 && h.bin_index(h.m_c.row(ih[r])) == h.bin_index(X.row(r)) && h.m_c.row(ih[r]) == ho.m_c.row(iho[r]) ;
+	check( ok , "argwhere: rows are found in their bin" ) ;
+
+	Eigen::MatrixXd Y = Eigen::MatrixXd::Constant(2,3,10.) ;
+	check( h.argwhere(Y) == Eigen::VectorXi::Constant(2,-1) , "argwhere: -1 outside of the support" ) ;
+}
+//}}}
+
+void test_parallel()//{{{
+{
+	Eigen::MatrixXd X = Eigen::MatrixXd::Random(50000,3) ;
+	Eigen::VectorXd bw(3) ; bw << 0.05 , 0.1 , 0.07 ;
+	std::vector<Eigen::VectorXd> edges(3) ;
+	for( int d = 0 ; d < 3 ; ++d )
+		edges[d] = Eigen::VectorXd::LinSpaced(12,-1,1).array().cube() ;
+	for( bool ordered : { false , true } )
+	{
+		SparseHist seq( X , bw , ordered , 1 ) , par( X , bw , ordered , 3 ) ;
+		check( same_hist( seq , par ) , "parallel: same histogram with 3 threads" ) ;
+		check( seq.argwhere(X) == par.argwhere(X) , "parallel: same argwhere with 3 threads" ) ;
+
+		SparseHist eseq( X , edges , ordered , 1 ) , epar( X , edges , ordered , 3 ) ;
+		check( same_hist( eseq , epar ) , "parallel: same histogram with 3 threads and bin_edges" ) ;
+	}
+}
+//}}}
+
+void test_bin_boundaries()//{{{
+{
+	// Samples lying exactly on bin edges must get the same bin on every path
+	Eigen::MatrixXd X(100000,1) ;
+	for( int i = 0 ; i < X.rows() ; ++i )
+		X(i,0) = 0.013 + (i - 50000) * 0.07 ;
+	Eigen::VectorXd bw = Eigen::VectorXd::Constant(1,0.07) , bo = Eigen::VectorXd::Constant(1,0.013) ;
+	SparseHist seq( X , bw , bo , false , 1 ) , par( X , bw , bo , false , 4 ) ;
+	check( same_hist( seq , par ) , "boundaries: same histogram with 4 threads" ) ;
+	check( ( par.argwhere(X).array() >= 0 ).all() , "boundaries: argwhere finds every training row" ) ;
+	par.build_tree() ;
+	check( ( par.argnearest(X).array() == par.argwhere(X).array() ).all() , "boundaries: argnearest matches argwhere" ) ;
+	bool ok = true ;
+	for( int i = 0 ; i < X.rows() ; ++i )
+		ok = ok && par.bin_index(X.row(i)) == seq.bin_index(X.row(i)) ;
+	check( ok , "boundaries: bin_index matches the histogram" ) ;
+	try { par.remove(X) ; par.finalize() ; check( par.m_size == 0 , "boundaries: remove empties the histogram" ) ; }
+	catch( const std::invalid_argument& ) { check( false , "boundaries: remove of the training rows" ) ; }
+}
+//}}}
+
+void test_streaming()//{{{
+{
+	Eigen::MatrixXd X = Eigen::MatrixXd::Random(30000,2) ;
+	Eigen::VectorXd bw(2) ; bw << 0.05 , 0.1 ;
+	Eigen::VectorXd bo = Eigen::VectorXd::Constant(2,0.01) ;
+	for( bool ordered : { false , true } )
+	{
+		for( SparseHist::size_type n_threads : { 1u , 2u } )
+		{
+			SparseHist full( X , bw , bo , ordered , n_threads ) ;
+
+			// Blocks pushed in order give the same histogram
+			SparseHist a( X.topRows(0) , bw , bo , ordered , n_threads ) ;
+			a.add( X.topRows(10000) ) ;
+			a.add( X.middleRows(10000,5000) ) ;
+			a.add( X.bottomRows(15000) ) ;
+			a.finalize() ;
+			check( same_hist( a , full ) , "streaming: blocks equal the one-shot histogram" ) ;
+
+			// Merging partial histograms gives the same histogram
+			SparseHist b( X.topRows(15000) , bw , bo , ordered , n_threads ) ;
+			SparseHist c( X.bottomRows(15000) , bw , bo , ordered , n_threads ) ;
+			b.merge(c) ;
+			b.finalize() ;
+			check( same_hist( b , full ) , "streaming: merge equals the one-shot histogram" ) ;
+		}
+	}
+
+	// Queries are refused until finalize
+	SparseHist h( X , bw , bo ) ;
+	h.build_tree() ;
+	Eigen::MatrixXd Y = Eigen::MatrixXd::Constant(1,2,10.) ;
+	h.add(Y) ;
+	bool thrown_where = false , thrown_nearest = false ;
+	try { h.argwhere(Y) ; } catch( std::logic_error& ) { thrown_where = true ; }
+	try { h.argnearest(Y) ; } catch( std::logic_error& ) { thrown_nearest = true ; }
+	check( thrown_where && thrown_nearest , "streaming: queries throw before finalize" ) ;
+	h.finalize() ;
+	check( h.argwhere(Y)[0] == static_cast<int>(h.m_size) - 1 , "streaming: new bin found after finalize" ) ;
+	h.remove(Y) ;
+	thrown_where = false ;
+	try { h.argwhere(Y) ; } catch( std::logic_error& ) { thrown_where = true ; }
+	check( thrown_where , "streaming: queries throw after remove" ) ;
+	h.finalize() ;
+	check( h.argwhere(Y)[0] == -1 && same_hist( h , SparseHist( X , bw , bo ) ) , "streaming: removed bin dropped by finalize" ) ;
+}
+//}}}
+
+void test_bin_edges()//{{{
+{
+	std::vector<Eigen::VectorXd> edges( 1 , Eigen::VectorXd(4) ) ;
+	edges[0] << 0. , 0.5 , 1. , 3. ;
+	Eigen::MatrixXd X(7,1) ;
+	X << -100. , -0.1 , 0.2 , 0.5 , 2.9 , 3. , 10. ;
+	SparseHist h( X , edges , true ) ;
+
+	// Each value has its own bin, the tails are extended with the outer widths
+	Eigen::VectorXd c(7) ;
+	c << -99.75 , -0.25 , 0.25 , 0.75 , 2. , 4. , 10. ;
+	Eigen::VectorXd w(7) ;
+	w << 0.5 , 0.5 , 0.5 , 0.5 , 2. , 2. , 2. ;
+	check( h.m_size == 7 && h.m_c.col(0) == c , "bin_edges: bins and centers outside of the edges" ) ;
+	check( h.bin_widths().col(0) == w , "bin_edges: width of each bin" ) ;
+	check( h.m_bin_width.size() == 0 && h.m_bin_origin.size() == 0 , "bin_edges: no single bin_width" ) ;
+	Eigen::VectorXi index = h.argwhere(X) ;
+	check( index == Eigen::VectorXi::LinSpaced(7,0,6) , "bin_edges: argwhere" ) ;
+
+	// Non uniform and regular grids are never merged
+	SparseHist r( X , Eigen::VectorXd::Constant(1,0.5) ) ;
+	bool thrown = false ;
+	try { h.merge(r) ; } catch( std::invalid_argument& ) { thrown = true ; }
+	check( thrown , "bin_edges: merge with a regular grid throws" ) ;
+}
+//}}}
+
+void test_remove()//{{{
+{
+	Eigen::MatrixXd X(6,1) ;
+	X << 0.1 , 0.3 , 0.5 , 0.7 , 0.9 , 1.1 ;
+	Eigen::VectorXd bw = Eigen::VectorXd::Constant(1,0.2) ;
+	SparseHist h( X , bw ) ;
+
+	// A row outside of the histogram: nothing is removed
+	Eigen::MatrixXd Y(3,1) ;
+	Y << 0.1 , 0.3 , 5.0 ;
+	bool thrown = false ;
+	try { h.remove(Y) ; } catch( std::invalid_argument& ) { thrown = true ; }
+	h.finalize() ;
+	check( thrown && h.m_n_samples == 6 && same_hist( h , SparseHist( X , bw ) ) , "remove: failed remove leaves the histogram unchanged" ) ;
+
+	// A bin asked more times than it is counted: nothing is removed
+	Eigen::MatrixXd Z(2,1) ;
+	Z << 0.1 , 0.15 ;
+	thrown = false ;
+	try { h.remove(Z) ; } catch( std::invalid_argument& ) { thrown = true ; }
+	h.finalize() ;
+	check( thrown && same_hist( h , SparseHist( X , bw ) ) , "remove: repeated bins are checked against their count" ) ;
+
+	// A valid remove equals the histogram of the remaining rows
+	h.remove( X.topRows(2) ) ;
+	h.finalize() ;
+	check( same_hist( h , SparseHist( X.bottomRows(4) , bw ) ) && std::abs( h.m_p.sum() - 1. ) < 1e-12 , "remove: equals the histogram of the remaining rows" ) ;
+}
+//}}}
+
+void test_add_bins()//{{{
+{
+	Eigen::MatrixXd X = Eigen::MatrixXd::Random(20000,3) ;
+	Eigen::VectorXd bw(3) ; bw << 0.05 , 0.1 , 0.2 ;
+	Eigen::VectorXd bo = Eigen::VectorXd::Constant(3,-0.3) ;
+	for( bool ordered : { false , true } )
+	{
+		SparseHist h( X , bw , bo , ordered ) ;
+		SparseHist r( X.topRows(0) , bw , bo , ordered ) ;
+		r.add_bins( h.bin_keys() , h.bin_counts() ) ;
+		r.finalize() ;
+		check( same_hist( h , r ) && r.m_n_samples == h.m_n_samples , "add_bins: round trip of bin_keys / bin_counts" ) ;
+		check( h.argwhere(X) == r.argwhere(X) , "add_bins: same argwhere after the round trip" ) ;
+	}
+
+	// Corrupted counts are refused, and nothing is added
+	SparseHist h( X , bw , bo ) ;
+	for( int bad : { 0 , -3 } )
+	{
+		SparseHist r( X.topRows(0) , bw , bo ) ;
+		Eigen::VectorXi counts = h.bin_counts() ;
+		counts[counts.size()-1] = bad ;
+		bool thrown = false ;
+		try { r.add_bins( h.bin_keys() , counts ) ; } catch( std::invalid_argument& ) { thrown = true ; }
+		check( thrown && r.m_keys.empty() && r.m_n_samples == 0 , "add_bins: non positive counts throw" ) ;
+	}
+
+	// The state is not exported between remove and finalize (emptied bins)
+	h.remove( X.topRows(5000) ) ;
+	bool thrown_keys = false , thrown_counts = false ;
+	try { h.bin_keys() ; } catch( std::logic_error& ) { thrown_keys = true ; }
+	try { h.bin_counts() ; } catch( std::logic_error& ) { thrown_counts = true ; }
+	check( thrown_keys && thrown_counts , "add_bins: bin_keys / bin_counts throw before finalize" ) ;
+	h.finalize() ;
+	SparseHist r( X.bottomRows(15000) , bw , bo ) ;
+	SparseHist s( X.topRows(0) , bw , bo ) ;
+	s.add_bins( h.bin_keys() , h.bin_counts() ) ;
+	s.finalize() ;
+	check( h.bin_counts().minCoeff() > 0 && s.m_n_samples == r.m_n_samples && s.m_size == r.m_size , "add_bins: round trip after remove and finalize" ) ;
+}
+//}}}
+
+void test_coarsen()//{{{
+{
+	Eigen::MatrixXd X = Eigen::MatrixXd::Random(20000,3) * 3 ;
+	Eigen::VectorXd bw(3) ; bw << 0.05 , 0.1 , 0.07 ;
+	Eigen::VectorXd bo = Eigen::VectorXd::Constant(3,0.013) ;
+	SparseHist fine( X , bw , bo , true ) ;
+	SparseHist coarse = fine.coarsen(4) ;
+	Eigen::VectorXd bw4 = bw * 4 ;
+	check( same_hist( coarse , SparseHist( X , bw4 , bo , true ) ) , "coarsen: equals the histogram on the coarse grid" ) ;
+
+	bool thrown = false ;
+	try { fine.coarsen(0) ; } catch( std::invalid_argument& ) { thrown = true ; }
+	check( thrown , "coarsen: factor 0 throws" ) ;
+	thrown = false ;
+	try { fine.coarsen( static_cast<SparseHist::size_type>(std::numeric_limits<int>::max()) + 1 ) ; } catch( std::invalid_argument& ) { thrown = true ; }
+	check( thrown , "coarsen: factor above INT_MAX throws" ) ;
+
+	// A const histogram can be coarsened, INT_MAX merges everything around the origin
+	const SparseHist& cfine = fine ;
+	SparseHist huge = cfine.coarsen( std::numeric_limits<int>::max() ) ;
+	check( huge.m_size <= 8 && huge.m_n_samples == fine.m_n_samples , "coarsen: factor INT_MAX" ) ;
+}
+//}}}
+
+void test_argnearest()//{{{
+{
+	Eigen::MatrixXd X = Eigen::MatrixXd::Random(50000,3) ;
+	Eigen::VectorXd bw(3) ; bw << 0.05 , 0.1 , 0.07 ;
+	SparseHist h( X , bw , false , 2 ) ;
+	h.build_tree() ;
+
+	Eigen::MatrixXd Y = Eigen::MatrixXd::Random(2000,3) * 1.5 ;
+	Eigen::VectorXi in = h.argwhere(Y) , near = h.argnearest(Y) , brute = brute_nearest(h,Y) ;
+	bool ok = true ;
+	for( int s = 0 ; s < Y.rows() ; ++s )
+	{
+		if( in[s] >= 0 )
+			ok = ok && near[s] == in[s] ;
+		else
+			ok = ok && ( h.m_c.row(near[s]) - Y.row(s) ).squaredNorm() == ( h.m_c.row(brute[s]) - Y.row(s) ).squaredNorm() ;
+	}
+	check( ok , "argnearest: argwhere in the support, brute force outside" ) ;
+
+	// Concurrent queries on the same histogram
+	Eigen::VectorXi near0 , near1 ;
+	std::thread t0( [&]() { near0 = h.argnearest(Y) ; } ) ;
+	std::thread t1( [&]() { near1 = h.argnearest(Y) ; } ) ;
+	t0.join() ;
+	t1.join() ;
+	check( near0 == near && near1 == near , "argnearest: concurrent queries" ) ;
+
+	// The tree follows finalize
+	h.add(Y) ;
+	h.finalize() ;
+	check( h.argnearest(Y) == h.argwhere(Y) , "argnearest: tree rebuilt by finalize" ) ;
+
+	SparseHist g( X , bw ) ;
+	bool thrown = false ;
+	try { g.argnearest(Y) ; } catch( std::logic_error& ) { thrown = true ; }
+	check( thrown , "argnearest: throws without build_tree" ) ;
+}
+//}}}
+
+
+//======//
+// main //
+//======//
+
+int main()
+{
+	std::srand(42) ;
+	test_argwhere() ;
+	test_parallel() ;
+	test_bin_boundaries() ;
+	test_streaming() ;
+	test_bin_edges() ;
+	test_remove() ;
+	test_add_bins() ;
+	test_coarsen() ;
+	test_argnearest() ;
+
+	if( n_failures > 0 )
+	{
+		std::cout << n_failures << " test(s) failed" << std::endl ;
+		return EXIT_FAILURE ;
+	}
+	std::cout << "Done" << std::endl ;
+	return EXIT_SUCCESS ;
+}